@@ -1,14 +1,91 @@
-from math import pi, tan, radians, cos
-from typing import Tuple, List, Optional
+from math import pi, tan, radians, cos, atan2, hypot, floor
+import sys
+from array import array
+from typing import Tuple, List
 from PIL import Image
 from .vector import Vec2
 from .mapstuff import Map, Texture, Intersection
 
 
-# Micro Optimization ideas:
+# Micro Optimization notes:
 #
-# - get rid of the Vector class and inline trig functions instead.
-#   (but that results in code that is less easier to understand)
+# - the rendering code doesn't use the Vector class but plain x and y floats and inlined trig functions,
+#   because creating a new Vec2 object for every operation is slow in the inner loops.
+#   The Vector class is still used for the player's position and direction, outside of the hot paths.
+
+
+def cast_ray(px: float, py: float, ray_x: float, ray_y: float, step_x: int, step_y: int,
+             t_delta_x: float, t_delta_y: float, grid: bytearray,
+             grid_width: int, max_distance: float) -> Tuple[int, float, float, Intersection]:
+    """Casts a single ray from (px, py) in direction (ray_x, ray_y) through the map grid.
+    step_x/step_y are the signs of the ray direction, and t_delta_x/t_delta_y the distances along the ray
+    between two vertical or horizontal grid lines (see ray_steps()).
+    The grid is the flat map grid with its wall border, grid_width the length of one of its rows (see Map).
+    Returns (wall, distance, wall texture sample coordinate, side). Wall is -1 if nothing was hit
+    within max_distance. The distance is in units of the ray direction vector."""
+    # This uses the DDA voxel traversal algorithm from Amanatides & Woo:
+    # instead of 'tracing the ray' with small steps, we hop from map square to map square
+    # by always crossing the nearest vertical or horizontal grid line.
+    # See https://lodev.org/cgtutor/raycasting.html and https://youtu.be/eOCQfxRQ2pY?t=6m0s
+    # The edge of the square that is hit follows directly from the grid line that was crossed,
+    # and the intersection point is simply the ray position at that distance.
+    # We only need to keep track of the index of the current square in the grid: because of the border,
+    # the ray hits a wall before it can leave the grid.
+    mx, my = int(px), int(py)
+    square_index = mx + 1 + (my + 1) * grid_width
+    index_step_y = step_y * grid_width
+    # the distances along the ray to the first vertical and horizontal grid lines
+    if step_x > 0:
+        t_max_x = (mx + 1 - px) * t_delta_x
+    elif step_x < 0:
+        t_max_x = (px - mx) * t_delta_x
+    else:
+        t_max_x = t_delta_x     # infinite, the ray never crosses a vertical grid line
+    if step_y > 0:
+        t_max_y = (my + 1 - py) * t_delta_y
+    elif step_y < 0:
+        t_max_y = (py - my) * t_delta_y
+    else:
+        t_max_y = t_delta_y     # infinite, the ray never crosses a horizontal grid line
+    while True:
+        if t_max_x < t_max_y:
+            t = t_max_x
+            if t > max_distance:
+                break
+            square_index += step_x
+            t_max_x += t_delta_x
+            square = grid[square_index]
+            if square:
+                # crossed a vertical grid line, so we hit the left or right edge of the square
+                iy = py + t * ray_y
+                if step_x > 0:
+                    return square, t, -iy, Intersection.LEFT
+                return square, t, iy, Intersection.RIGHT
+        else:
+            t = t_max_y
+            if t > max_distance:
+                break
+            square_index += index_step_y
+            t_max_y += t_delta_y
+            square = grid[square_index]
+            if square:
+                # crossed a horizontal grid line, so we hit the bottom or top edge of the square
+                ix = px + t * ray_x
+                if step_y > 0:
+                    return square, t, ix, Intersection.BOTTOM
+                return square, t, -ix, Intersection.TOP
+    # no wall is hit within the maximum distance
+    return -1, max_distance, 0.0, Intersection.TOP
+
+
+def ray_steps(ray: float) -> Tuple[int, float]:
+    """Returns the sign of the given ray direction component (x or y),
+    and the distance along the ray it takes to travel 1 unit in that direction."""
+    if ray > 0:
+        return 1, 1.0 / ray
+    elif ray < 0:
+        return -1, -1.0 / ray
+    return 0, float("inf")
 
 
 class Raycaster:
@@ -18,11 +95,27 @@ class Raycaster:
     def __init__(self, pixwidth: int, pixheight: int) -> None:
         self.pixwidth = pixwidth
         self.pixheight = pixheight
+        # the z-buffer is a flat list stored row by row, like the frame buffer: (x, y) is at index x + y*pixwidth
         self.empty_zbuffer = [float("inf")] * pixheight * pixwidth
         self.zbuffer = self.empty_zbuffer[:]
         self.ceiling_sizes = [0] * pixwidth
+        self.column_walls = [0] * pixwidth
+        self.column_distances = [0.0] * pixwidth
+        self.column_texture_xs = [0.0] * pixwidth
+        self.column_sides = [Intersection.TOP] * pixwidth
+        self.column_rays_x = [0.0] * pixwidth
+        self.column_rays_y = [0.0] * pixwidth
+        self.column_steps_x = [0] * pixwidth
+        self.column_steps_y = [0] * pixwidth
+        self.column_t_deltas_x = [0.0] * pixwidth
+        self.column_t_deltas_y = [0.0] * pixwidth
+        # how far along the camera plane (-1 ... 1) the ray through every pixel column is
+        self.column_plane_factors = [(x / pixwidth - 0.5) * 2 for x in range(pixwidth)]
         self.image = Image.new('RGB', (pixwidth, pixheight), color=0)
-        self.image_buf = self.image.load()
+        # The pixels are drawn in this frame buffer, which is copied into the image once per frame.
+        # Every pixel is a color packed in a 32 bits integer (see Texture), so it's just a single store.
+        self.pixbuf = array('I', [0]) * (pixwidth * pixheight)
+        self.pixbuf_rawmode = "RGBX" if sys.byteorder == "little" else "XBGR"
         self.textures = {
             "test": Texture("textures/test.png"),
             "floor": Texture("textures/floor.png"),
@@ -37,7 +130,9 @@ class Raycaster:
         self.frame = 0
         self.player_position = Vec2(0, 0)
         self.player_direction = Vec2(0, 1)
-        self.camera_plane = Vec2(tan(self.HVOF / 2), 0)
+        self.tan_half_fov = tan(self.HVOF / 2)
+        self.camera_plane = Vec2(self.tan_half_fov, 0)
+        self.update_column_rays()
         self.map = Map(["11111111111111111111",
                         "1..................1",
                         "1..111111222222.2221",
@@ -58,222 +153,311 @@ class Raycaster:
         # NOTE: multithreading is not useful because of Python's GIL
         #       multiprocessing is probably not useful because of IPC overhead to sync the world state...
         d_screen = self.screen_distance()
+        self.cast_rays()
         for x in range(self.pixwidth):
-            wall, distance, texture_x, side = self.cast_ray(x)
+            wall = self.column_walls[x]
+            distance = self.column_distances[x]
             if distance > 0:
                 ceiling_size = int(self.pixheight * (1.0 - d_screen / distance) / 2.0)
                 self.ceiling_sizes[x] = ceiling_size
                 if wall > 0:
-                    self.draw_column(x, ceiling_size, distance, self.wall_textures[wall], texture_x, side)
+                    self.draw_column(x, ceiling_size, distance, self.wall_textures[wall],
+                                     self.column_texture_xs[x], self.column_sides[x])
                 else:
                     self.draw_black_column(x, ceiling_size, distance)
             else:
                 self.ceiling_sizes[x] = 0
         self.draw_floor_and_ceiling(self.ceiling_sizes, d_screen)
         self.draw_sprites(d_screen)
+        # copy the whole frame buffer into the image at once (this is a single memory copy)
+        self.image.frombytes(memoryview(self.pixbuf).cast('B'), "raw", self.pixbuf_rawmode)
 
-    def cast_ray(self, pixel_x: int) -> Tuple[int, float, float, Intersection]:
-        # TODO more efficient xy dda algorithm: use map square dx/dy steps to hop map squares,
-        #      instead of 'tracing the ray' with small steps. See https://lodev.org/cgtutor/raycasting.html
-        #      and https://youtu.be/eOCQfxRQ2pY?t=6m0s
-        #      That also makes the intersection test a lot simpler!?
-        camera_plane_ray = (pixel_x / self.pixwidth - 0.5) * 2 * self.camera_plane
-        cast_ray = self.player_direction + camera_plane_ray
-        distance = 0.0     # distance perpendicular to the camera view plane
-        step_size = 0.02   # lower this to increase ray resolution
-        ray = self.player_position
-        ray_step = cast_ray * step_size
-        while distance <= self.BLACK_DISTANCE:
-            distance += step_size
-            ray += ray_step
-            square = self.map_square(ray.x, ray.y)
-            if square:
-                side, tx, _ = self.intersection_with_mapsquare_accurate(self.player_position, ray)
-                # XXX tx = self.intersection_with_mapsquare_fast(ray)
-                return square, distance, tx, side
-        return -1, distance, 0.0, Intersection.TOP
+    def cast_rays(self) -> None:
+        """Casts the rays for all pixel columns on the screen in a single pass.
+        The results are stored in the column_walls, column_distances, column_texture_xs and column_sides lists."""
+        # Everything that is the same for all columns is looked up once, outside of the loop.
+        px, py = self.player_position.x, self.player_position.y
+        rays_x, rays_y = self.column_rays_x, self.column_rays_y
+        steps_x, steps_y = self.column_steps_x, self.column_steps_y
+        t_deltas_x, t_deltas_y = self.column_t_deltas_x, self.column_t_deltas_y
+        grid, grid_width = self.map.grid, self.map.grid_width
+        black_distance = self.BLACK_DISTANCE
+        walls, distances, texture_xs, sides = \
+            self.column_walls, self.column_distances, self.column_texture_xs, self.column_sides
+        for pixel_x in range(self.pixwidth):
+            walls[pixel_x], distances[pixel_x], texture_xs[pixel_x], sides[pixel_x] = \
+                cast_ray(px, py, rays_x[pixel_x], rays_y[pixel_x], steps_x[pixel_x], steps_y[pixel_x],
+                         t_deltas_x[pixel_x], t_deltas_y[pixel_x], grid, grid_width, black_distance)
 
-    def intersection_with_mapsquare_fast(self, cast_ray: Vec2) -> float:
-        """Cast_ray is the ray that we know intersects with a square.
+    def intersection_with_mapsquare_fast(self, ray_x: float, ray_y: float) -> float:
+        """(ray_x, ray_y) is the point of the ray that we know intersects with a square.
         This method returns only the needed wall texture sample coordinate."""
         # Note: this method is rather fast, but is inaccurate.
         # When the ray intersects near a corner of the square, sometimes the wrong edge is determined.
         # Also, the texture sample coordinate is directly taken from the cast ray,
         # instead of the actual intersection point.
-        square_center = Vec2(int(cast_ray.x) + 0.5, int(cast_ray.y) + 0.5)
-        angle = (cast_ray - square_center).angle()
-        # consider the angle (which gives the quadrant in the map square) rotated by pi/4
-        # to find the edge of the square it intersects with
-        if -pi*.25 <= angle < pi*.25:
+        dx = ray_x - int(ray_x) - 0.5
+        dy = ray_y - int(ray_y) - 0.5
+        # consider the direction from the center of the square (which gives the quadrant in the map square)
+        # rotated by pi/4 to find the edge of the square it intersects with.
+        # The diagonals of the square are where |dx| == |dy|, so no angle has to be calculated.
+        if -dx <= dy < dx:
             # right edge
-            return cast_ray.y
-        elif pi*.25 <= angle < pi*.75:
+            return ray_y
+        elif -dx < dy and dx <= dy:
             # top edge
-            return -cast_ray.x
-        elif -pi*.75 <= angle < -pi*.25:
+            return -ray_x
+        elif dy < -dx and dy <= dx:
             # bottom edge
-            return cast_ray.x
+            return ray_x
         else:
             # left edge
-            return -cast_ray.y
+            return -ray_y
 
-    def intersection_with_mapsquare_accurate(self, camera: Vec2, cast_ray: Vec2) -> Tuple[Intersection, float, Vec2]:
-        """Cast_ray is the ray that we know intersects with a square.
-        This method returns (side, wall texture sample coordinate, Vec2(intersect x, intersect y))."""
+    def intersection_with_mapsquare_accurate(self, camera_x: float, camera_y: float, ray_x: float, ray_y: float) \
+            -> Tuple[Intersection, float, Tuple[float, float]]:
+        """(ray_x, ray_y) is the point of the ray from the camera that we know intersects with a square.
+        This method returns (side, wall texture sample coordinate, (intersect x, intersect y))."""
         # Note: this method is a bit slow, but very accurate.
         # It always determines the correct quadrant/edge that is intersected,
         # and calculates the texture sample coordinate based off the actual intersection point
         # of the cast camera ray with that square's edge.
         # We now first determine what quadrant of the square the camera is looking at,
-        # and based on the relative angle with the vertex, what edge of the square.
-        direction = cast_ray - camera
-        square_center = Vec2(int(cast_ray.x) + 0.5, int(cast_ray.y) + 0.5)
-        if camera.x < square_center.x:
+        # and based on which side of the vertex the ray passes, what edge of the square.
+        # The side is the sign of the cross product of the vertex and direction vectors,
+        # so no angles have to be calculated.
+        direction_x = ray_x - camera_x
+        direction_y = ray_y - camera_y
+        center_x = int(ray_x) + 0.5
+        center_y = int(ray_y) + 0.5
+        if camera_x < center_x:
             # left half of square
-            if camera.y < square_center.y:
-                vertex_angle = ((square_center + Vec2(-0.5, -0.5)) - camera).angle()
-                intersects = Intersection.BOTTOM if direction.angle() < vertex_angle else Intersection.LEFT
+            vertex_x = center_x - 0.5 - camera_x
+            if camera_y < center_y:
+                vertex_y = center_y - 0.5 - camera_y
+                clockwise = vertex_x * direction_y - vertex_y * direction_x < 0
+                intersects = Intersection.BOTTOM if clockwise else Intersection.LEFT
             else:
-                vertex_angle = ((square_center + Vec2(-0.5, 0.5)) - camera).angle()
-                intersects = Intersection.LEFT if direction.angle() < vertex_angle else Intersection.TOP
+                vertex_y = center_y + 0.5 - camera_y
+                clockwise = vertex_x * direction_y - vertex_y * direction_x < 0
+                intersects = Intersection.LEFT if clockwise else Intersection.TOP
         else:
-            # right half of square (need to flip some X's because of angle sign issue)
-            if camera.y < square_center.y:
-                vertex = ((square_center + Vec2(0.5, -0.5)) - camera)
-                vertex.x = -vertex.x
-                positive_dir = Vec2(-direction.x, direction.y)
-                intersects = Intersection.BOTTOM if positive_dir.angle() < vertex.angle() else Intersection.RIGHT
+            # right half of square
+            vertex_x = center_x + 0.5 - camera_x
+            if camera_y < center_y:
+                vertex_y = center_y - 0.5 - camera_y
+                counterclockwise = vertex_x * direction_y - vertex_y * direction_x > 0
+                intersects = Intersection.BOTTOM if counterclockwise else Intersection.RIGHT
             else:
-                vertex = ((square_center + Vec2(0.5, 0.5)) - camera)
-                vertex.x = -vertex.x
-                positive_dir = Vec2(-direction.x, direction.y)
-                intersects = Intersection.RIGHT if positive_dir.angle() < vertex.angle() else Intersection.TOP
+                vertex_y = center_y + 0.5 - camera_y
+                counterclockwise = vertex_x * direction_y - vertex_y * direction_x > 0
+                intersects = Intersection.RIGHT if counterclockwise else Intersection.TOP
         # now calculate the exact x (and y) coordinates of the intersection with the square's edge
         if intersects == Intersection.TOP:
-            iy = square_center.y + 0.5
-            ix = 0.0 if direction.y == 0 else camera.x + (iy - camera.y) * direction.x / direction.y
-            return intersects, -ix, Vec2(ix, iy)
+            iy = center_y + 0.5
+            ix = 0.0 if direction_y == 0 else camera_x + (iy - camera_y) * direction_x / direction_y
+            return intersects, -ix, (ix, iy)
         elif intersects == Intersection.BOTTOM:
-            iy = square_center.y - 0.5
-            ix = 0.0 if direction.y == 0 else camera.x + (iy - camera.y) * direction.x / direction.y
-            return intersects, ix, Vec2(ix, iy)
+            iy = center_y - 0.5
+            ix = 0.0 if direction_y == 0 else camera_x + (iy - camera_y) * direction_x / direction_y
+            return intersects, ix, (ix, iy)
         elif intersects == Intersection.LEFT:
-            ix = square_center.x - 0.5
-            iy = 0.0 if direction.x == 0 else camera.y + (ix - camera.x) * direction.y / direction.x
-            return intersects, -iy, Vec2(ix, iy)
+            ix = center_x - 0.5
+            iy = 0.0 if direction_x == 0 else camera_y + (ix - camera_x) * direction_y / direction_x
+            return intersects, -iy, (ix, iy)
         else:   # right edge
-            ix = square_center.x + 0.5
-            iy = 0.0 if direction.x == 0 else camera.y + (ix - camera.x) * direction.y / direction.x
-            return intersects, iy, Vec2(ix, iy)
+            ix = center_x + 0.5
+            iy = 0.0 if direction_x == 0 else camera_y + (ix - camera_x) * direction_y / direction_x
+            return intersects, iy, (ix, iy)
 
     def map_square(self, x: float, y: float) -> int:
-        mx = int(x)
-        my = int(y)
-        if mx < 0 or mx >= self.map.width or my < 0 or my >= self.map.height:
-            return 255
-        return self.map.get_wall(mx, my)
+        # No bounds check: x and y must be within -1 ... width+1 and -1 ... height+1, which is the map
+        # and the wall border around it in the grid (see Map). That's always the case for the player position.
+        # floor() is used because int() would truncate coordinates between -1 and 0 into the map itself.
+        return self.map.grid[floor(x) + 1 + (floor(y) + 1) * self.map.grid_width]
 
     def brightness(self, distance: float) -> float:
         return max(0.0, 1.0 - distance / self.BLACK_DISTANCE)
 
+    def brightness_level(self, distance: float) -> int:
+        """Returns the brightness at the given distance as an index in the texture shades (see Texture)."""
+        return int(self.brightness(distance) * (Texture.SHADES - 1) + 0.5)
+
     def draw_column(self, x: int, ceiling: int, distance: float,
                     texture: Texture, tx: float, side: Intersection) -> None:
         start_y = max(0, ceiling)
         num_pixels = self.pixheight - 2*start_y
         wall_height = self.pixheight - 2*ceiling
-        brightness = self.brightness(distance)      # the whole column has the same brightness value
+        brightness = self.brightness_level(distance)      # the whole column has the same brightness value
         # if we wanted, a simple form of "sunlight" can be added here so that not all walls have the same brightness:
         # if side in (Intersection.TOP, Intersection.RIGHT):      # make the sun 'shine' from bottom left
-        #     brightness *= 0.75
-        for y in range(start_y, start_y+num_pixels):
-            self.set_pixel(x, y, distance, brightness, texture.sample(tx, (y-ceiling) / wall_height))
+        #     brightness = brightness * 3 // 4
+        # The whole column samples the same texture column, and the texture row is a fixed step per screen pixel.
+        # So we walk the (pre-shaded) texture directly instead of calling sample() and scaling the brightness
+        # for every pixel. The texture row is calculated from the pixel row with integer arithmetic
+        # instead of accumulated, so that rounding errors don't shift it at the texel boundaries.
+        texels = texture.shades[brightness]
+        tex_size = Texture.SIZE
+        size_shift = Texture.SIZE_SHIFT
+        tex_x = int(tx * tex_size) & Texture.SIZE_MASK
+        wall_y = start_y - ceiling
+        pixbuf = self.pixbuf
+        pixwidth = self.pixwidth
+        offset = x + start_y * pixwidth
+        # The walls are drawn first and every column only contains a single wall,
+        # so no z-buffer test is needed here: every pixel of the column is visible.
+        self.zbuffer[offset:offset + num_pixels*pixwidth:pixwidth] = [distance] * num_pixels
+        for i in range(wall_y, wall_y + num_pixels):
+            pixbuf[offset] = texels[((i * tex_size // wall_height) << size_shift) | tex_x]
+            offset += pixwidth
 
     def draw_black_column(self, x: int, ceiling: int, distance: float) -> None:
         start_y = max(0, ceiling)
         num_pixels = self.pixheight - 2*start_y
-        for y in range(start_y, start_y+num_pixels):
-            self.set_pixel(x, y, distance, 1.0, (0, 0, 0, 0))
+        offset = x + start_y * self.pixwidth
+        end = offset + num_pixels * self.pixwidth
+        # just like a wall column, this is always visible
+        self.zbuffer[offset:end:self.pixwidth] = [distance] * num_pixels
+        self.pixbuf[offset:end:self.pixwidth] = array('I', [0]) * num_pixels
 
     def draw_floor_and_ceiling(self, ceiling_sizes: List[int], d_screen: float) -> None:
         mcs = max(ceiling_sizes)
         if mcs <= 0:
             return
         max_height_possible = int(self.pixheight*(1.0-d_screen/self.BLACK_DISTANCE)/2.0)
-        ceiling_tex = self.textures["ceiling"]
-        floor_tex = self.textures["floor"]
+        ceiling_shades = self.textures["ceiling"].shades
+        floor_shades = self.textures["floor"].shades
+        tex_size = Texture.SIZE
+        size_mask = Texture.SIZE_MASK
+        size_shift = Texture.SIZE_SHIFT
+        px, py = self.player_position.x, self.player_position.y
+        dir_x, dir_y = self.player_direction.x, self.player_direction.y
+        plane_x, plane_y = self.camera_plane.x, self.camera_plane.y
+        pixwidth, pixheight = self.pixwidth, self.pixheight
+        inv_pixheight = 1.0 / pixheight
+        plane_step_x = 2 * plane_x / pixwidth
+        plane_step_y = 2 * plane_y / pixwidth
+        zbuffer = self.zbuffer
+        pixbuf = self.pixbuf
+        # The ceiling (and floor) in a column is visible from the top of the screen down to the wall,
+        # so the columns visible on a row are the ones with a ceiling size larger than the row number.
+        # With the columns sorted on ceiling size, those are simply the first ones, and the number of them
+        # only decreases as we go down the rows. That way we only ever visit the pixels that are visible.
+        columns = sorted(range(pixwidth), key=ceiling_sizes.__getitem__, reverse=True)
+        num_visible = pixwidth
         for y in range(min(mcs, max_height_possible)):
-            sy = 0.5 - y / self.pixheight
+            while ceiling_sizes[columns[num_visible-1]] <= y:
+                num_visible -= 1
+            sy = 0.5 - y * inv_pixheight
             d_ground = 0.5 * d_screen / sy    # how far, horizontally over the ground, is this away from us?
-            brightness = self.brightness(d_ground)
-            for x, h in enumerate(ceiling_sizes):
-                if y < h and d_ground < self.zbuffer[x+y*self.pixwidth]:
-                    camera_plane_ray = (x / self.pixwidth - 0.5) * 2 * self.camera_plane
-                    ray = self.player_position + d_ground*(self.player_direction + camera_plane_ray)
-                    # we use the fact that the ceiling and floor are mirrored
-                    self.set_pixel(x, y, d_ground, brightness, ceiling_tex.sample(ray.x, ray.y))
-                    self.set_pixel(x, self.pixheight-y-1, d_ground, brightness, floor_tex.sample(ray.x, ray.y))
+            brightness = self.brightness_level(d_ground)
+            ceiling_texels = ceiling_shades[brightness]
+            floor_texels = floor_shades[brightness]
+            # All pixels on this row see the ground at the same distance, so the point on the ground
+            # moves with a fixed step from one pixel column to the next.
+            tex_x = (px + d_ground * (dir_x - plane_x)) * tex_size
+            tex_y = (py + d_ground * (dir_y - plane_y)) * tex_size
+            tex_step_x = d_ground * plane_step_x * tex_size
+            tex_step_y = d_ground * plane_step_y * tex_size
+            ceiling_offset = y * pixwidth
+            floor_offset = (pixheight-y-1) * pixwidth
+            # The visible pixels don't need a z-buffer test because the sprites are drawn later.
+            # This includes the floor pixel, because the ceiling and floor are mirrored:
+            # the texel position is calculated once and used for both of them.
+            if num_visible == pixwidth:
+                # the whole row is visible, draw it with slice assignments
+                texels = [((int(tex_y + x * tex_step_y) & size_mask) << size_shift) |
+                          (int(tex_x + x * tex_step_x) & size_mask) for x in range(pixwidth)]
+                zbuffer[ceiling_offset:ceiling_offset + pixwidth] = zbuffer[floor_offset:floor_offset + pixwidth] = \
+                    [d_ground] * pixwidth
+                pixbuf[ceiling_offset:ceiling_offset + pixwidth] = array('I', [ceiling_texels[t] for t in texels])
+                pixbuf[floor_offset:floor_offset + pixwidth] = array('I', [floor_texels[t] for t in texels])
+                continue
+            for x in columns[:num_visible]:
+                texel = ((int(tex_y + x * tex_step_y) & size_mask) << size_shift) | \
+                        (int(tex_x + x * tex_step_x) & size_mask)
+                zbuffer[ceiling_offset + x] = d_ground
+                zbuffer[floor_offset + x] = d_ground
+                pixbuf[ceiling_offset + x] = ceiling_texels[texel]
+                pixbuf[floor_offset + x] = floor_texels[texel]
 
     def draw_sprites(self, d_screen: float) -> None:
+        px, py = self.player_position.x, self.player_position.y
+        player_angle = atan2(self.player_direction.y, self.player_direction.x)
+        half_fov = self.HVOF / 2
+        column_distances = self.column_distances
+        visible_sprites = []    # type: List[Tuple[float, float, str]]
         for (mx, my), mc in self.map.sprites.items():
-            sprite_pos = Vec2(mx + 0.5, my + 0.5)
-            sprite_vec = sprite_pos - self.player_position
-            sprite_direction = sprite_vec.angle()
-            sprite_distance = sprite_vec.magnitude()
-            sprite_view_angle = self.player_direction.angle() - sprite_direction
+            sprite_x = mx + 0.5 - px
+            sprite_y = my + 0.5 - py
+            sprite_distance = hypot(sprite_x, sprite_y)
+            sprite_view_angle = player_angle - atan2(sprite_y, sprite_x)
             if sprite_view_angle < -pi:
                 sprite_view_angle += 2*pi
             elif sprite_view_angle > pi:
                 sprite_view_angle -= 2*pi
-            if sprite_distance < self.BLACK_DISTANCE and abs(sprite_view_angle) < self.HVOF/2:
-                if mc == "g":
-                    texture = self.textures["creature-gargoyle"]
-                    sprite_size = 0.8
-                elif mc == "h":
-                    texture = self.textures["creature-hero"]
-                    sprite_size = 0.7
-                elif mc == "t":
-                    texture = self.textures["treasure"]
-                    sprite_size = 0.6
-                else:
-                    raise KeyError("unknown sprite: " + mc)
-                middle_pixel_column = int((0.5*(sprite_view_angle/(self.HVOF/2))+0.5) * self.pixwidth)
-                sprite_perpendicular_distance = sprite_distance * cos(sprite_view_angle)
-                ceiling_above_sprite_square = int(self.pixheight *
-                                                  (1.0 - d_screen / sprite_perpendicular_distance) / 2.0)
-                if ceiling_above_sprite_square >= 0:
-                    # TODO: sprite clipping in y axis if they're getting to near, instead of just removing it altogether
-                    brightness = self.brightness(sprite_perpendicular_distance)
-                    pixel_height = self.pixheight - ceiling_above_sprite_square*2
-                    y_offset = int((1.0-sprite_size) * pixel_height)
-                    ceiling_above_sprite_square += y_offset
-                    pixel_height = int(sprite_size * pixel_height)
-                    pixel_width = pixel_height
-                    for y in range(pixel_height):
-                        for x in range(max(0, int(middle_pixel_column - pixel_width/2)),
-                                       min(self.pixwidth, int(middle_pixel_column + pixel_width/2))):
-                            tc = texture.sample((x-middle_pixel_column)/pixel_width - 0.5, y/pixel_height)
-                            if tc[3] > 200:  # consider alpha channel
-                                self.set_pixel(x, y+ceiling_above_sprite_square,
-                                               sprite_perpendicular_distance, brightness, tc)
-
-    def set_pixel(self, x: int, y: int, z: float, brightness: float, rgba: Optional[Tuple[int, int, int, int]]) -> None:
-        """Sets a pixel on the screen (if it is visible) and adjusts its z-buffer value.
-        The pixel's brightness is adjusted as well.
-        If rgba is None, the pixel is transparent instead of having a color."""
-        if rgba and z < self.zbuffer[x+y*self.pixwidth]:
-            self.zbuffer[x+y*self.pixwidth] = z
-            if z > 0 and brightness != 1.0:
-                rgba = self.color_brightness(rgba, brightness)
-            self.image_buf[x, y] = rgba
-
-    def color_brightness(self, rgba: Tuple[int, int, int, int], brightness: float) -> Tuple[int, int, int, int]:
-        """adjust brightness of the color. brightness 0=pitch black, 1=normal"""
-        # while theoretically it's more accurate to adjust the luminosity (by doing rgb->hls->rgb),
-        # it's almost as good and a lot faster to just scale the r,g,b values themselves.
-        # from colorsys import rgb_to_hls, hls_to_rgb
-        # h, l, s = rgb_to_hls(*rgb)
-        # r, g, b = hls_to_rgb(h, l*scale, s)
-        return int(rgba[0] * brightness), int(rgba[1] * brightness), int(rgba[2] * brightness), rgba[3]
+            if sprite_distance < self.BLACK_DISTANCE and abs(sprite_view_angle) < half_fov:
+                visible_sprites.append((sprite_distance * cos(sprite_view_angle), sprite_view_angle, mc))
+        # Draw the sprites front to back: the pixels of a sprite that are hidden behind a nearer sprite
+        # then fail the z-buffer test, and are never drawn over again.
+        visible_sprites.sort()
+        for sprite_perpendicular_distance, sprite_view_angle, mc in visible_sprites:
+            if mc == "g":
+                texture = self.textures["creature-gargoyle"]
+                sprite_size = 0.8
+            elif mc == "h":
+                texture = self.textures["creature-hero"]
+                sprite_size = 0.7
+            elif mc == "t":
+                texture = self.textures["treasure"]
+                sprite_size = 0.6
+            else:
+                raise KeyError("unknown sprite: " + mc)
+            middle_pixel_column = int((0.5*(sprite_view_angle/half_fov)+0.5) * self.pixwidth)
+            ceiling_above_sprite_square = int(self.pixheight *
+                                              (1.0 - d_screen / sprite_perpendicular_distance) / 2.0)
+            if ceiling_above_sprite_square >= 0:
+                # TODO: sprite clipping in y axis if they're getting to near, instead of just removing it altogether
+                brightness = self.brightness_level(sprite_perpendicular_distance)
+                pixel_height = self.pixheight - ceiling_above_sprite_square*2
+                y_offset = int((1.0-sprite_size) * pixel_height)
+                ceiling_above_sprite_square += y_offset
+                pixel_height = int(sprite_size * pixel_height)
+                pixel_width = pixel_height
+                texels = texture.shades[brightness]
+                alpha = texture.alpha
+                tex_size = Texture.SIZE
+                size_mask = Texture.SIZE_MASK
+                size_shift = Texture.SIZE_SHIFT
+                start_x = max(0, int(middle_pixel_column - pixel_width/2))
+                end_x = min(self.pixwidth, int(middle_pixel_column + pixel_width/2))
+                z = sprite_perpendicular_distance
+                # A screen column where the sprite is behind the wall is hidden entirely, because
+                # the floor and ceiling in that column are closer than the wall as well.
+                # So the columns on the sides of the sprite that are hidden are skipped before
+                # doing any texture sampling, and if no column is visible, the sprite is skipped altogether.
+                while start_x < end_x and z >= column_distances[start_x]:
+                    start_x += 1
+                while start_x < end_x and z >= column_distances[end_x-1]:
+                    end_x -= 1
+                if start_x == end_x:
+                    continue
+                # the texture column for every screen column is the same for all rows, so calculate it once
+                inv_pixel_width = 1.0 / pixel_width
+                texel_columns = [int(((x-middle_pixel_column)*inv_pixel_width - 0.5) * tex_size) & size_mask
+                                 for x in range(start_x, end_x)]
+                zbuffer = self.zbuffer
+                pixbuf = self.pixbuf
+                pixwidth = self.pixwidth
+                for y in range(pixel_height):
+                    texel_row = ((y * tex_size // pixel_height) & size_mask) << size_shift
+                    offset = start_x + (y+ceiling_above_sprite_square) * pixwidth
+                    for texel_column in texel_columns:
+                        texel = texel_row | texel_column
+                        if z < zbuffer[offset] and alpha[texel] > 200:  # consider alpha channel
+                            zbuffer[offset] = z
+                            pixbuf[offset] = texels[texel]
+                        offset += 1
 
     def move_player_forward_or_back(self, amount: float) -> None:
         new = self.player_position + amount * self.player_direction.normalized()
@@ -303,11 +487,27 @@ class Raycaster:
 
     def rotate_player_to(self, angle: float) -> None:
         self.player_direction = Vec2.from_angle(angle)
-        self.camera_plane = Vec2.from_angle(angle - pi / 2) * tan(self.HVOF / 2)
+        self.camera_plane = Vec2.from_angle(angle - pi / 2) * self.tan_half_fov
+        self.update_column_rays()
+
+    def update_column_rays(self) -> None:
+        """Calculates the direction of the camera ray through every pixel column on the screen,
+        and the step sizes of the DDA grid traversal along those rays.
+        These only change when the player rotates or the field of view changes, not every frame."""
+        dir_x, dir_y = self.player_direction.x, self.player_direction.y
+        plane_x, plane_y = self.camera_plane.x, self.camera_plane.y
+        for x, camera_plane_factor in enumerate(self.column_plane_factors):
+            ray_x = dir_x + camera_plane_factor * plane_x
+            ray_y = dir_y + camera_plane_factor * plane_y
+            self.column_rays_x[x] = ray_x
+            self.column_rays_y[x] = ray_y
+            self.column_steps_x[x], self.column_t_deltas_x[x] = ray_steps(ray_x)
+            self.column_steps_y[x], self.column_t_deltas_y[x] = ray_steps(ray_y)
 
     def set_fov(self, fov: float) -> None:
         self.HVOF = fov
+        self.tan_half_fov = tan(fov / 2)
         self.rotate_player(0.0)
 
     def screen_distance(self):
-        return 0.5/(tan(self.HVOF/2) * self.pixheight/self.pixwidth)
+        return 0.5/(self.tan_half_fov * self.pixheight/self.pixwidth)
@@ -80,8 +80,9 @@ class Window(tkinter.Tk):
     def intersect(self) -> None:
         self.canvas.itemconfigure(self.square, fill='teal')
         cast_ray = self.camera + self.direction
-        side, texture_coordinate, intersection = self.raycaster.intersection_with_mapsquare_accurate(self.camera, cast_ray)
-        sx, sy = self.to_screen(intersection.x, intersection.y)
+        side, texture_coordinate, (ix, iy) = self.raycaster.intersection_with_mapsquare_accurate(
+            self.camera.x, self.camera.y, cast_ray.x, cast_ray.y)
+        sx, sy = self.to_screen(ix, iy)
         self.canvas.coords(self.intersect_point, sx-5, sy-5, sx+5, sy+5)
         self.texcoord_lbl.configure(text=f"texture coordinate: {texture_coordinate:.2f}")
 
@@ -100,12 +101,12 @@ def bench():
     import time
     begin = time.perf_counter()
     for _ in range(100000):
-        r.intersection_with_mapsquare_accurate(camera, cast_ray)
+        r.intersection_with_mapsquare_accurate(camera.x, camera.y, cast_ray.x, cast_ray.y)
     duration = time.perf_counter() - begin
     print(f"original accurate took: {duration:.2f} sec")
     begin = time.perf_counter()
     for _ in range(100000):
-        r.intersection_with_mapsquare_fast(cast_ray)
+        r.intersection_with_mapsquare_fast(cast_ray.x, cast_ray.y)
     duration = time.perf_counter() - begin
     print(f"new took: {duration:.2f} sec")
 